@@ -1,95 +1,77 @@
 import pandas as pd
+import numpy as np
 import streamlit as st
-import os
-from datetime import datetime
 import altair as alt
-from dotenv import load_dotenv
-import s3_utils
+import kakeibo_pipeline
+import metric_cards
+import config
 import duckdb
 
 print("balance.pyが読み込まれました")
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
-
-S3_BUCKET_NAME = os.environ["S3_BUCKET_NAME"]
-S3_PREFIX = os.environ["S3_PREFIX"]
+# 収入区分（0: 収入以外、1: 給与、2: 賞与（一時所得）、3: その他収入）
+INCOME_CLASS_NONE = 0
+INCOME_CLASS_SALARY = 1
+INCOME_CLASS_BONUS = 2
+INCOME_CLASS_OTHER = 3
 
+@st.cache_data(ttl="1h")
 def preprocess_kakeibo_data(kakeibo_df: pd.DataFrame) -> pd.DataFrame:
-    """家計簿データを前処理する
+    """家計簿データを収支分析用に前処理する
 
-    - カラム名を英語に変換
-    - データ型の変換
-    - カテゴリの整理
-    - 計算対象外のものの除外
-    - 振替対象のものの除外
+    - 中項目のcategory型への変換
+    - 収入区分（給与・賞与・その他収入）の分類
 
-    :param kakeibo_df: 家計簿データ
+    :param kakeibo_df: 共通の前処理済みの家計簿データ
     :type kakeibo_df: pd.DataFrame
     :return: 前処理済みの家計簿データ
     :rtype: pd.DataFrame
     """
 
-    df = kakeibo_df.copy()
-
-    # カラム名を英語に変換して扱いやすくする
-    columns_mapping = {
-        "計算対象": "is_target",
-        "日付": "date",
-        "内容": "description",
-        "金額（円）": "amount",
-        "保有金融機関": "financial_institution",
-        "大項目": "major_category",
-        "中項目": "minor_category",
-        "メモ": "memo",
-        "振替": "is_transfer",
-        "ID": "id"
-    }
-    df = df.rename(columns=columns_mapping)
-
-    # データ操作や集計をしやすくするために日付をdatetime型に変換
-    df['date'] = pd.to_datetime(df['date'])
-
-    # 計算対象と振替のフラグを数値型に変換
-    df['is_target'] = df['is_target'].astype(int)
-    df['is_transfer'] = df['is_transfer'].astype(int)
+    # 中項目も種類が少ないのでcategory型にし、文字列ではなくコードで比較する（大項目は共通の前処理で変換済み）
+    df = kakeibo_df.assign(minor_category=kakeibo_df['minor_category'].astype('category'))
 
     # 「収入」カテゴリの分類
-    df['is_salary'] = df['major_category'].str.contains('収入') & df['minor_category'].str.contains('給与')
-    df['is_bonus'] = df['major_category'].str.contains('収入') & df['minor_category'].str.contains('一時所得')
-    df['is_other_income'] = df['major_category'].str.contains('収入') & ~(df['minor_category'].str.contains('給与') | df['minor_category'].str.contains('一時所得'))
-
-    # 計算対象外のものは削除
-    df = df[df['is_target'] == 1]
+    # 大項目・中項目の組み合わせは数種類しかないため、組み合わせごとに収入区分を決めてから全行に割り当てる
+    category_pairs = df[['major_category', 'minor_category']].drop_duplicates()
+    category_pairs['income_class'] = np.where(
+        category_pairs['major_category'] == config.INCOME_CATEGORY,
+        np.select(
+            [category_pairs['minor_category'] == '給与', category_pairs['minor_category'] == '一時所得'],
+            [INCOME_CLASS_SALARY, INCOME_CLASS_BONUS],
+            default=INCOME_CLASS_OTHER
+        ),
+        INCOME_CLASS_NONE
+    ).astype('int8')
+    df = df.merge(category_pairs, on=['major_category', 'minor_category'], how='left')
 
-    # 振替対象のものは削除
-    df = df[df['is_transfer'] == 0]
+    # is_incomeは給与・賞与・その他収入のいずれか
+    df['is_income'] = df['income_class'] != INCOME_CLASS_NONE
+    df['is_salary'] = df['income_class'] == INCOME_CLASS_SALARY
+    df['is_bonus'] = df['income_class'] == INCOME_CLASS_BONUS
+    df['is_other_income'] = df['income_class'] == INCOME_CLASS_OTHER
 
     return df
 
-def summarize_monthly_kakeibo_data(preprocessed_kakeibo_df: pd.DataFrame) -> pd.DataFrame:
-    """月単位の家計簿データをDuckDBで集計する
+@st.cache_data(ttl="1h")
+def summarize_monthly_kakeibo_data(monthly_amounts: pd.DataFrame) -> pd.DataFrame:
+    """サマリー・詳細データ用の月別の家計簿データを作成する
 
-    :param preprocessed_kakeibo_df: 前処理済みの家計簿データ
-    :type preprocessed_kakeibo_df: pd.DataFrame
+    グラフと同じ月別集計から計算するため、取引データを集計し直さない。
+
+    :param monthly_amounts: 月別の給与・給与以外の収入・支出のデータ
+    :type monthly_amounts: pd.DataFrame
     :return: 月別集計した家計簿データ
     :rtype: pd.DataFrame
     """
 
-    query = """
-    SELECT 
-        date_trunc('month', date) AS year_month_dt,
-        COALESCE(SUM(CASE WHEN is_salary THEN amount ELSE 0 END), 0) AS income_only_salary,
-        COALESCE(SUM(CASE WHEN is_salary OR is_bonus OR is_other_income THEN amount ELSE 0 END), 0) AS income_with_others,
-        COALESCE(SUM(CASE WHEN NOT (is_salary OR is_bonus OR is_other_income) THEN amount ELSE 0 END), 0) AS expense
-    FROM preprocessed_kakeibo_df
-    GROUP BY date_trunc('month', date)
-    ORDER BY year_month_dt
-    """
-    
-    # DuckDBでクエリを実行し、Pandas DataFrameとして取得
-    monthly_summary = duckdb.query(query).df()
-    
+    monthly_summary = pd.DataFrame({
+        'year_month_dt': kakeibo_pipeline.year_month_to_timestamp(monthly_amounts['year_month']),
+        'income_only_salary': monthly_amounts['income_salary'],
+        'income_with_others': monthly_amounts['income_salary'] + monthly_amounts['income_others'],
+        'expense': monthly_amounts['total_expense']
+    })
+
     # 既存のロジック・グラフとの互換性のため year_month カラムを追加
     monthly_summary['year_month'] = monthly_summary['year_month_dt'].dt.to_period('M')
 
@@ -98,23 +80,6 @@ def summarize_monthly_kakeibo_data(preprocessed_kakeibo_df: pd.DataFrame) -> pd.
 
     return monthly_summary
 
-
-def get_kakeibo_data_range(preprocessed_kakeibo_df: pd.DataFrame) -> tuple[datetime, datetime]:
-    """
-    家計簿データの日付範囲を取得する
-
-    :param preprocessed_kakeibo_df: 前処理済みの家計簿データ
-    :type preprocessed_kakeibo_df: pd.DataFrame
-    :return: 最古の日付, 最新の日付のタプル
-    :rtype: tuple[datetime, datetime]
-    """
-
-    # date列の最小値と最大値を取得
-    oldest_date: datetime = preprocessed_kakeibo_df['date'].min()
-    newest_date: datetime = preprocessed_kakeibo_df['date'].max()
-
-    return oldest_date, newest_date
-
 def display_summaries(monthly_kakeibo_summary: pd.DataFrame, preprocessed_kakeibo_df: pd.DataFrame):
     """収支サマリーを3列レイアウトで表示する
 
@@ -139,7 +104,7 @@ def display_summaries(monthly_kakeibo_summary: pd.DataFrame, preprocessed_kakeib
     monthly_avg = monthly_avg.round(0).astype(int)
 
     # データ期間情報を取得
-    start_date, end_date = get_kakeibo_data_range(preprocessed_kakeibo_df)
+    start_date, end_date = kakeibo_pipeline.get_kakeibo_data_range(preprocessed_kakeibo_df)
     months_count = len(monthly_kakeibo_summary)
 
     # 指標を3列で表示
@@ -149,31 +114,21 @@ def display_summaries(monthly_kakeibo_summary: pd.DataFrame, preprocessed_kakeib
         # 収入関連の指標
         st.markdown("### 💰 収入")
 
-        income_metrics = [
+        metric_cards.display_metric_cards([
             {"title": "総収入", "value": total_income_with_others},
             {"title": "総収入（給与のみ）", "value": total_income_only_salary},
             {"title": "月平均収入", "value": monthly_avg['income_with_others']},
             {"title": "月平均収入（給与のみ）", "value": monthly_avg['income_only_salary']}
-        ]
-
-        for metric in income_metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            con.markdown(f"### :blue[¥ {metric['value']:,.0f}]")
+        ], color="blue")
 
     with col2:
         # 支出関連の指標
         st.markdown("### 💸 支出")
 
-        expense_metrics = [
+        metric_cards.display_metric_cards([
             {"title": "総支出", "value": -total_expense},
             {"title": "月平均支出", "value": -monthly_avg['expense']}
-        ]
-
-        for metric in expense_metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            con.markdown(f"### :red[¥ {metric['value']:,.0f}]")
+        ], color="red")
 
     with col3:
         # 収支バランス関連の指標
@@ -186,73 +141,113 @@ def display_summaries(monthly_kakeibo_summary: pd.DataFrame, preprocessed_kakeib
             {"title": "月平均収支バランス（給与のみ）", "value": monthly_avg['balance_only_salary']}
         ]
 
+        # 収支がマイナスの指標だけ色を変える
         for metric in balance_metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            if metric['value'] >= 0:
-                con.markdown(f"### :green[¥ {metric['value']:,.0f}]")
-            else:
-                con.markdown(f"### :orange[¥ {metric['value']:,.0f}]")
+            if metric['value'] < 0:
+                metric['color'] = "orange"
+
+        metric_cards.display_metric_cards(balance_metrics, color="green")
 
     # データ期間情報を表示
     st.info(f"📅 **データ期間:** {start_date.strftime('%Y/%m/%d')} 〜 {end_date.strftime('%Y/%m/%d')} （{months_count}ヶ月）")
 
-def plot_monthly_balance_trend(preprocessed_kakeibo_df: pd.DataFrame, include_bonus: bool = True):
-    """月別収支のトレンドをプロットする"""
-
-    # 前処理済みのデータを使用
-    df = preprocessed_kakeibo_df.copy()
+@st.cache_data(ttl="1h")
+def summarize_monthly_amounts(preprocessed_kakeibo_df: pd.DataFrame) -> pd.DataFrame:
+    """月別の給与・給与以外の収入・支出を集計する
 
-    # 年月のカラムを追加
-    df['year_month'] = df['date'].dt.to_period('M')
+    収支グラフはいずれもこの3つの合計から計算できるため、集計は1回で済ませる。
 
-    if include_bonus:
-        # 月ごとの収入と支出を集計
-        monthly_summary = df.groupby('year_month').agg(
-            total_income=('amount', lambda x: x[(df['is_salary'] | df['is_bonus'] | df['is_other_income'])].sum()),
-            total_expense=('amount', lambda x: x[~(df['is_salary'] | df['is_bonus'] | df['is_other_income'])].sum())
-        ).reset_index()
+    :param preprocessed_kakeibo_df: 前処理済みの家計簿データ
+    :type preprocessed_kakeibo_df: pd.DataFrame
+    :return: 月別の給与（income_salary）・給与以外の収入（income_others）・支出（total_expense）のデータ
+    :rtype: pd.DataFrame
+    """
 
-        income_label = '収入'
+    df = preprocessed_kakeibo_df
+
+    # 年月（1970年1月からの月数）
+    # 元のデータをコピーせずに済むよう、カラムとして追加せずに配列のまま使う
+    year_month = kakeibo_pipeline.to_year_month(df['date'])
+
+    # 最古の月からの月数を添字にする
+    oldest_month = year_month.min()
+    month_index = year_month - oldest_month
+    month_counts = np.bincount(month_index)
+    has_data = month_counts > 0  # 取引のない月はgroupbyと同様に結果に含めない
+
+    # 前処理で割り当てた収入区分を使い、月×収入区分ごとの金額を1回のbincountで足し込む
+    # （区分ごとのマスクを作らずに済み、groupbyのハッシュ・ソートも省ける）
+    income_class_count = INCOME_CLASS_OTHER + 1
+    amounts_by_class = np.bincount(
+        month_index * income_class_count + df['income_class'].to_numpy(),
+        weights=df['amount'].to_numpy(),
+        minlength=len(month_counts) * income_class_count
+    ).reshape(-1, income_class_count)[has_data].astype('int64')
+
+    return pd.DataFrame({
+        'year_month': np.flatnonzero(has_data).astype('int32') + oldest_month,
+        'income_salary': amounts_by_class[:, INCOME_CLASS_SALARY],
+        'income_others': amounts_by_class[:, INCOME_CLASS_BONUS] + amounts_by_class[:, INCOME_CLASS_OTHER],
+        'total_expense': amounts_by_class[:, INCOME_CLASS_NONE]
+    })
+
+@st.cache_data(ttl="1h")
+def summarize_monthly_balance_trend(monthly_amounts: pd.DataFrame, include_bonus: bool = True) -> tuple[pd.DataFrame, str]:
+    """月別収支のトレンドのグラフ用データを集計する
+
+    :param monthly_amounts: 月別の給与・給与以外の収入・支出のデータ
+    :type monthly_amounts: pd.DataFrame
+    :param include_bonus: 収入に賞与・その他収入を含めるかどうか
+    :type include_bonus: bool
+    :return: 月別の収入・支出・収支バランスのデータと、収入のラベル
+    :rtype: tuple[pd.DataFrame, str]
+    """
 
-        # 収支バランスを計算（収入 - 支出）
-        monthly_summary['balance'] = monthly_summary['total_income'] + monthly_summary['total_expense']  # 支出は負の値なので加算
+    monthly_summary = monthly_amounts[['year_month', 'total_expense']].copy()
 
+    if include_bonus:
+        monthly_summary['total_income'] = monthly_amounts['income_salary'] + monthly_amounts['income_others']
+        income_label = '収入'
     else:
-        # 月ごとの収入と支出を集計
-        monthly_summary = df.groupby('year_month').agg(
-            total_income=('amount', lambda x: x[df['is_salary']].sum()),
-            total_expense=('amount', lambda x: x[~(df['is_salary'] | df['is_bonus'] | df['is_other_income'])].sum())
-        ).reset_index()
-
+        monthly_summary['total_income'] = monthly_amounts['income_salary']
         income_label = '収入（給与のみ）'
 
-        # 収支バランスを計算（収入 - 支出）
-        monthly_summary['balance'] = monthly_summary['total_income'] + monthly_summary['total_expense']  # 支出は負の値なので加算
+    # 収支バランスを計算（収入 - 支出）
+    monthly_summary['balance'] = monthly_summary['total_income'] + monthly_summary['total_expense']  # 支出は負の値なので加算
 
     # 支出は正の値として表示するため、符号を反転（グラフ用）
     monthly_summary['total_expense_positive'] = -monthly_summary['total_expense']
 
-    # year_monthをstring型に変換してソート
-    monthly_summary['year_month_str'] = monthly_summary['year_month'].astype(str)
-    monthly_summary['year_month_dt'] = monthly_summary['year_month'].dt.to_timestamp()
+    # year_monthを日付・文字列に変換してソート
+    monthly_summary['year_month_dt'] = kakeibo_pipeline.year_month_to_timestamp(monthly_summary['year_month'])
+    monthly_summary['year_month_str'] = monthly_summary['year_month_dt'].dt.strftime('%Y-%m')
     monthly_summary = monthly_summary.sort_values('year_month_dt')
 
-    income_expense_data = pd.melt(
-        monthly_summary,
-        id_vars=['year_month_str', 'year_month_dt'],
-        value_vars=['total_income', 'total_expense_positive'],
-        var_name='category',
-        value_name='amount'
-    )
+    return monthly_summary, income_label
 
-    # カテゴリ名をわかりやすく変更
-    category_mapping = {
-        'total_income': income_label,
-        'total_expense_positive': '支出'
-    }
+@st.cache_data(ttl="1h")
+def build_monthly_balance_chart(monthly_summary: pd.DataFrame, income_label: str) -> dict:
+    """月別収支のトレンドのグラフ（Vega-Liteの仕様）を作成する
 
-    income_expense_data['category'] = income_expense_data['category'].map(category_mapping)
+    :param monthly_summary: 月別の収入・支出・収支バランスのデータ
+    :type monthly_summary: pd.DataFrame
+    :param income_label: 収入のラベル
+    :type income_label: str
+    :return: Vega-Liteのグラフ仕様
+    :rtype: dict
+    """
+
+    # 収入・支出の2系列を縦に並べたデータを作成（カテゴリ名は系列ごとにまとめて割り当てる）
+    months_count = len(monthly_summary)
+    income_expense_data = pd.DataFrame({
+        'year_month_str': np.tile(monthly_summary['year_month_str'].to_numpy(), 2),
+        'year_month_dt': np.tile(monthly_summary['year_month_dt'].to_numpy(), 2),
+        'category': np.repeat([income_label, '支出'], months_count),
+        'amount': np.concatenate([
+            monthly_summary['total_income'].to_numpy(),
+            monthly_summary['total_expense_positive'].to_numpy()
+        ])
+    })
 
     # 棒グラフ作成（グループ化された棒グラフ）
     bar_chart = alt.Chart(income_expense_data).mark_bar().encode(
@@ -308,27 +303,27 @@ def plot_monthly_balance_trend(preprocessed_kakeibo_df: pd.DataFrame, include_bo
         title=f'月別の{income_label}・支出および収支バランスの推移'
     )
 
-    st.altair_chart(chart, use_container_width=True)
+    return chart.to_dict()
 
-def plot_cumulative_balance_trend(preprocessed_kakeibo_df: pd.DataFrame):
-    """月別収支の累積トレンドをプロットする"""
+def plot_monthly_balance_trend(monthly_amounts: pd.DataFrame, include_bonus: bool = True):
+    """月別収支のトレンドをプロットする"""
+
+    monthly_summary, income_label = summarize_monthly_balance_trend(monthly_amounts, include_bonus)
 
-    df = preprocessed_kakeibo_df.copy()
-    df['year_month'] = df['date'].dt.to_period('M')
+    st.vega_lite_chart(spec=build_monthly_balance_chart(monthly_summary, income_label), use_container_width=True)
+
+def plot_cumulative_balance_trend(monthly_amounts: pd.DataFrame):
+    """月別収支の累積トレンドをプロットする"""
 
     # 賞与込みの集計
-    monthly_summary_all = df.groupby('year_month').agg(
-        total_income=('amount', lambda x: x[(df['is_salary'] | df['is_bonus'] | df['is_other_income'])].sum()),
-        total_expense=('amount', lambda x: x[~(df['is_salary'] | df['is_bonus'] | df['is_other_income'])].sum())
-    ).reset_index()
+    monthly_summary_all = monthly_amounts[['year_month', 'total_expense']].copy()
+    monthly_summary_all['total_income'] = monthly_amounts['income_salary'] + monthly_amounts['income_others']
     monthly_summary_all['balance'] = monthly_summary_all['total_income'] + monthly_summary_all['total_expense']
     monthly_summary_all['category'] = '賞与込み'
 
     # 給与のみの集計
-    monthly_summary_salary = df.groupby('year_month').agg(
-        total_income=('amount', lambda x: x[df['is_salary']].sum()),
-        total_expense=('amount', lambda x: x[~(df['is_salary'] | df['is_bonus'] | df['is_other_income'])].sum())
-    ).reset_index()
+    monthly_summary_salary = monthly_amounts[['year_month', 'total_expense']].copy()
+    monthly_summary_salary['total_income'] = monthly_amounts['income_salary']
     monthly_summary_salary['balance'] = monthly_summary_salary['total_income'] + monthly_summary_salary['total_expense']
     monthly_summary_salary['category'] = '給与のみ'
 
@@ -336,14 +331,17 @@ def plot_cumulative_balance_trend(preprocessed_kakeibo_df: pd.DataFrame):
     monthly_summary = pd.concat([monthly_summary_all, monthly_summary_salary], ignore_index=True)
 
     # 累積を計算するため、一度各カテゴリごとにソートして計算
-    monthly_summary['year_month_dt'] = monthly_summary['year_month'].dt.to_timestamp()
-    monthly_summary['year_month_str'] = monthly_summary['year_month'].astype(str)
+    monthly_summary['year_month_dt'] = kakeibo_pipeline.year_month_to_timestamp(monthly_summary['year_month'])
+    monthly_summary['year_month_str'] = monthly_summary['year_month_dt'].dt.strftime('%Y-%m')
     
     monthly_summary = monthly_summary.sort_values(['category', 'year_month_dt'])
     monthly_summary['cumulative_balance'] = monthly_summary.groupby('category')['balance'].cumsum()
 
+    # グラフのデータはブラウザに送信されるため、エンコードに使うカラムだけに絞る
+    chart_data = monthly_summary[['year_month_str', 'year_month_dt', 'category', 'cumulative_balance']]
+
     # 線グラフ作成
-    line_chart = alt.Chart(monthly_summary).mark_line(
+    line_chart = alt.Chart(chart_data).mark_line(
         point=True,
         strokeWidth=3
     ).encode(
@@ -383,7 +381,7 @@ def main():
     # S3から家計簿データを取得
     ###############################################################
     with st.spinner("家計簿データを取得中..."):
-        kakeibo_data: pd.DataFrame = s3_utils.read_csv_files_from_s3(bucket_name=S3_BUCKET_NAME, prefix=S3_PREFIX)
+        kakeibo_data: pd.DataFrame = kakeibo_pipeline.load_preprocessed_kakeibo_data()
 
     if kakeibo_data is None or kakeibo_data.empty:
         st.warning("家計簿データが見つかりませんでした。")
@@ -422,7 +420,9 @@ def main():
     ###############################################################
     # 月単位のデータ集計
     ###############################################################
-    monthly_kakeibo_summary: pd.DataFrame = summarize_monthly_kakeibo_data(filtered_kakeibo_data)
+    # サマリー・各グラフで共通の月別集計（給与・給与以外の収入・支出）
+    monthly_amounts: pd.DataFrame = summarize_monthly_amounts(filtered_kakeibo_data)
+    monthly_kakeibo_summary: pd.DataFrame = summarize_monthly_kakeibo_data(monthly_amounts)
 
     ###############################################################
     # サマリーを表示
@@ -436,21 +436,22 @@ def main():
     st.header("📊 グラフ")
 
     # 月別収支推移のグラフを表示（賞与込み）
-    plot_monthly_balance_trend(filtered_kakeibo_data)
+    plot_monthly_balance_trend(monthly_amounts)
 
     # 月別収支推移のグラフを表示（賞与なし）
-    plot_monthly_balance_trend(filtered_kakeibo_data, include_bonus=False)
+    plot_monthly_balance_trend(monthly_amounts, include_bonus=False)
 
     # 累積収支推移のグラフを表示（2本線）
-    plot_cumulative_balance_trend(filtered_kakeibo_data)
+    plot_cumulative_balance_trend(monthly_amounts)
 
     # 詳細データを表示
     st.header("📋 詳細データ")
     with st.expander("月別収支データ", expanded=False):
         # データを見やすく整形
-        display_df = monthly_kakeibo_summary.copy()
-        display_df['year_month'] = display_df['year_month'].astype(str)
-        display_df = display_df.rename(columns={
+        # 表示用の年月だけを差し替える（集計結果はコピーしない）
+        display_df = monthly_kakeibo_summary.assign(
+            year_month=monthly_kakeibo_summary['year_month'].astype(str)
+        ).rename(columns={
             'year_month': '年月',
             'income_only_salary': '収入（給与のみ）（円）',
             'income_with_others': '収入（賞与込み）（円）',
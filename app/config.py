@@ -1,12 +1,24 @@
 # 固定費と変動費の分類設定
 
+# 収入に該当する大項目（収支分析・固定費/変動費分析で共通）
+INCOME_CATEGORY = "収入"
+
 # 固定費に該当する大項目
-FIXED_COST_CATEGORIES = [
+# 実行中に書き換えられないようタプルにする（表示順を保つため集合にはしない）
+FIXED_COST_CATEGORIES = (
     "通信費",
     "保険",
     "水道・光熱費",
     "住宅"
-]
+)
+
+# 食費に該当する中項目
+FOOD_CATEGORIES = (
+    "食費-会",
+    "食費-家・外",
+    "食費-家・中",
+    "食費-個・外"
+)
 
 # その他の設定
 CHART_COLORS = {
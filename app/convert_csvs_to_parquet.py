@@ -0,0 +1,17 @@
+import os
+from dotenv import load_dotenv
+import s3_utils
+
+# S3上の家計簿CSVをParquetデータセットに一括変換する管理用スクリプト
+# 使い方: python app/convert_csvs_to_parquet.py
+
+# .envファイルから環境変数を読み込む
+load_dotenv()
+
+S3_BUCKET_NAME = os.environ["S3_BUCKET_NAME"]
+S3_PREFIX = os.environ["S3_PREFIX"]
+S3_PARQUET_PREFIX = os.environ["S3_PARQUET_PREFIX"]
+
+if __name__ == "__main__":
+    converted_count = s3_utils.convert_csvs_to_parquet(S3_BUCKET_NAME, S3_PREFIX, S3_PARQUET_PREFIX)
+    print(f"{converted_count}ファイルをParquetに変換しました。")
@@ -1,10 +1,9 @@
 from dotenv import load_dotenv
 import streamlit as st
-import pandas as pd
 import re
-from io import StringIO
 import datetime
 import os
+import pyarrow as pa
 import s3_utils
 
 # .envファイルから環境変数を読み込む
@@ -12,6 +11,7 @@ load_dotenv()
 
 S3_BUCKET_NAME = os.environ["S3_BUCKET_NAME"]
 S3_PREFIX = os.environ["S3_PREFIX"]
+S3_PARQUET_PREFIX = os.environ["S3_PARQUET_PREFIX"]
 
 # 必要なカラムリスト
 REQUIRED_COLUMNS = [
@@ -19,21 +19,21 @@ REQUIRED_COLUMNS = [
     "大項目", "中項目", "メモ", "振替", "ID"
 ]
 
-# ファイル名の正規表現パターン
-FILE_PATTERN = r"収入・支出詳細_(\d{4}-\d{2}-\d{2})_(\d{4}-\d{2}-\d{2})\.csv"
+# ファイル名の正規表現パターン（年・月・日をそれぞれ取り出せるようにモジュール読み込み時にコンパイルしておく）
+FILE_PATTERN = re.compile(r"収入・支出詳細_(\d{4})-(\d{2})-(\d{2})_(\d{4})-(\d{2})-(\d{2})\.csv")
 
 def validate_file_name(file_name):
     """ファイル名が正しい形式かどうかを検証"""
-    match = re.match(FILE_PATTERN, file_name)
+    match = FILE_PATTERN.match(file_name)
     if not match:
         return False, "ファイル名が正しい形式ではありません。「収入・支出詳細_YYYY-MM-DD_YYYY-MM-DD.csv」形式である必要があります。"
 
-    start_date_str = match.group(1)
-    end_date_str = match.group(2)
+    start_year, start_month, start_day, end_year, end_month, end_day = map(int, match.groups())
 
     try:
-        start_date = datetime.datetime.strptime(start_date_str, "%Y-%m-%d")
-        end_date = datetime.datetime.strptime(end_date_str, "%Y-%m-%d")
+        # 形式は正規表現で確認済みのため、strptimeを使わずに数値から直接日付を作成する
+        start_date = datetime.datetime(start_year, start_month, start_day)
+        end_date = datetime.datetime(end_year, end_month, end_day)
 
         # 日付の順序チェック
         if start_date >= end_date:
@@ -43,16 +43,18 @@ def validate_file_name(file_name):
     except ValueError:
         return False, "日付の形式が不正です。"
 
-def validate_csv_content(df):
+def validate_csv_content(column_names):
     """CSVの内容を検証"""
     # カラム名の確認
-    missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+    # カラム名を集合にしておき、各カラムの有無を定数時間で確認する（表示順はREQUIRED_COLUMNSの順に保つ）
+    columns = set(column_names)
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in columns]
     if missing_columns:
         return False, f"必要なカラムがありません: {', '.join(missing_columns)}"
 
     return True, "CSVの内容は有効です。"
 
-def determine_s3_key(start_date):
+def determine_s3_key(start_date, prefix=S3_PREFIX):
     """ファイル名から適切なS3のキーを決定"""
     # マネーフォワードの仕様によると、ファイルは翌月の給与支給日までのデータを含む
     # 例: 収入・支出詳細_2024-12-25_2025-01-23.csv は2025年1月分として扱う
@@ -63,7 +65,7 @@ def determine_s3_key(start_date):
     year = next_month.year
     month = next_month.month
 
-    s3_key = f"{S3_PREFIX}/year={year}/month={month}"
+    s3_key = f"{prefix}/year={year}/month={month}"
     return s3_key
 
 def main():
@@ -94,12 +96,17 @@ def main():
 
         # CSVの読み込みと内容の検証
         try:
-            # StringIO経由でデータを読み取る
-            string_data = StringIO(uploaded_file.getvalue().decode('shift-jis'))
-            df = pd.read_csv(string_data)
+            # ヘッダーと先頭のブロックだけを読み込む（ファイル全体はアップロード時のParquet変換でパースする）
+            # 先頭のブロックに型変換できない値（数値でない金額など）があれば、この時点でエラーになる
+            try:
+                csv_reader = s3_utils.open_kakeibo_csv(uploaded_file.getvalue())
+                first_batch = next(iter(csv_reader), None)
+            except pa.ArrowInvalid as e:
+                st.error(f"CSVの内容が不正です: {e}")
+                return
 
             # 内容の検証
-            is_valid_content, content_message = validate_csv_content(df)
+            is_valid_content, content_message = validate_csv_content(csv_reader.schema.names)
             if not is_valid_content:
                 st.error(content_message)
                 return
@@ -109,7 +116,9 @@ def main():
 
             # データプレビュー
             st.subheader("データプレビュー")
-            st.dataframe(df.head())
+            # ヘッダーのみのCSVの場合は空のプレビューを表示する
+            preview_table = first_batch if first_batch is not None else csv_reader.schema.empty_table()
+            st.dataframe(preview_table.to_pandas().head())
 
             # S3に保存するパスの決定
             s3_key = determine_s3_key(start_date)
@@ -121,16 +130,34 @@ def main():
                 uploaded_file.seek(0)
                 file_content = uploaded_file.read()
 
+                # 検証したのは先頭のブロックだけのため、書き込む前にファイル全体をパースする
+                # 型変換できない値があれば、CSVとParquetのどちらも書き込まない（S3上のCSVとParquetを食い違わせない）
+                try:
+                    kakeibo_table = s3_utils.read_kakeibo_csv_as_table(file_content)
+                except pa.ArrowInvalid as e:
+                    st.error(f"CSVの内容が不正です: {e}")
+                    return
+
                 with st.spinner("S3にアップロード中..."):
                     # S3にアップロード
-                    success, result = s3_utils.upload_to_s3(S3_BUCKET_NAME, file_content, file_name, s3_key)
+                    success, result = s3_utils.upload_to_s3(file_content, file_name, S3_BUCKET_NAME, s3_key)
 
                     if success:
                         st.success(f"ファイルを S3 にアップロードしました: {result}")
-                        # アップロード成功時にCSV読み込みのキャッシュをクリアする
-                        s3_utils.read_csv_files_from_s3.clear()
                     else:
                         st.error(f"アップロード中にエラーが発生しました: {result}")
+                        return
+
+                    # 分析ページ用にParquetとしてアップロード（パース済みのデータを使う）
+                    parquet_s3_key = determine_s3_key(start_date, prefix=S3_PARQUET_PREFIX)
+                    success, result = s3_utils.write_parquet_to_s3(kakeibo_table, file_name, S3_BUCKET_NAME, parquet_s3_key)
+
+                    if success:
+                        st.success(f"Parquetファイルを S3 にアップロードしました: {result}")
+                        # アップロード成功時にファイル一覧のキャッシュをクリアし、分析ページで新しいファイルが読み込まれるようにする
+                        s3_utils.list_parquet_files.clear()
+                    else:
+                        st.error(f"Parquetのアップロード中にエラーが発生しました: {result}")
 
         except Exception as e:
             st.error(f"ファイル処理中にエラーが発生しました: {str(e)}")
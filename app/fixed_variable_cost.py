@@ -1,67 +1,12 @@
 import streamlit as st
 import pandas as pd
-import s3_utils
-import os
-from datetime import datetime
-import altair as alt
-from dotenv import load_dotenv
+import numpy as np
+import kakeibo_pipeline
+import metric_cards
 import config
+# altairは読み込みに時間がかかるため、グラフを描画する関数の中で読み込む
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
-
-S3_BUCKET_NAME = os.environ["S3_BUCKET_NAME"]
-S3_PREFIX = os.environ["S3_PREFIX"]
-
-def preprocess_kakeibo_data(kakeibo_df: pd.DataFrame) -> pd.DataFrame:
-    """家計簿データを前処理する
-    :param kakeibo_df: 家計簿データ
-    :type kakeibo_df: pd.DataFrame
-    :return: 前処理済みの家計簿データ
-    :rtype: pd.DataFrame
-    """
-
-    df = kakeibo_df.copy()
-
-    # カラム名を英語に変換して扱いやすくする
-    columns_mapping = {
-        "計算対象": "is_target",
-        "日付": "date",
-        "内容": "description",
-        "金額（円）": "amount",
-        "保有金融機関": "financial_institution",
-        "大項目": "major_category",
-        "中項目": "minor_category",
-        "メモ": "memo",
-        "振替": "is_transfer",
-        "ID": "id"
-    }
-    df = df.rename(columns=columns_mapping)
-
-    # データ操作や集計をしやすくするために日付をdatetime型に変換
-    df['date'] = pd.to_datetime(df['date'])
-
-    # 計算対象と振替のフラグを数値型に変換
-    df['is_target'] = df['is_target'].astype(int)
-    df['is_transfer'] = df['is_transfer'].astype(int)
-
-    # 「収入」カテゴリの分類
-    df['is_income'] = df['major_category'].str.contains('収入', na=False)
-
-    # 固定費と変動費の分類（設定ファイルに基づく）
-    df['is_fixed_cost'] = df['major_category'].isin(config.FIXED_COST_CATEGORIES)
-
-    # 変動費フラグの作成（収入でなく、固定費でもないものを変動費と分類）
-    df['is_variable_cost'] = ~df['is_income'] & ~df['is_fixed_cost']
-
-    # 計算対象外のものは削除
-    df = df[df['is_target'] == 1]
-
-    # 振替対象のものは削除
-    df = df[df['is_transfer'] == 0]
-
-    return df
-
+@st.cache_data(ttl="1h")
 def summarize_monthly_fixed_variable_costs(preprocessed_kakeibo_df: pd.DataFrame) -> pd.DataFrame:
     """月単位の固定費と変動費を集計する
 
@@ -70,46 +15,44 @@ def summarize_monthly_fixed_variable_costs(preprocessed_kakeibo_df: pd.DataFrame
     :return: 月別集計した固定費・変動費データ
     :rtype: pd.DataFrame
     """
-    df = preprocessed_kakeibo_df.copy()
-
-    # 月別で集計するため、年月のカラムを追加
-    df['year_month'] = df['date'].dt.to_period('M')
-
     # 収入データを除外（支出だけを集計）
-    expense_df = df[~df['is_income']]
-
-    # 固定費と変動費のデータを分離
-    fixed_cost_df = expense_df[expense_df['is_fixed_cost']]
-    variable_cost_df = expense_df[expense_df['is_variable_cost']]
+    expense_df = preprocessed_kakeibo_df[~preprocessed_kakeibo_df['is_income']]
+
+    # 月ごとの金額はint32に収まるため、集計結果もint32で保持する（比率は表示の精度を保つためfloat64のまま）
+
+    # 年月（1970年1月からの月数）の最古の月からの月数を添字にする
+    year_month = kakeibo_pipeline.to_year_month(expense_df['date'])
+    oldest_month = year_month.min() if year_month.size else 0
+    month_index = year_month - oldest_month
+    month_counts = np.bincount(month_index)
+    has_data = month_counts > 0  # 取引のない月はgroupbyと同様に結果に含めない
+
+    # 固定費・変動費に該当する金額だけを月ごとに足し込む（groupbyのハッシュ・ソートを省く）
+    # 支出は負の値なので正に変換
+    amount = expense_df['amount'].to_numpy()
+    fixed_cost = np.bincount(
+        month_index, weights=np.where(expense_df['is_fixed_cost'].to_numpy(), amount, 0), minlength=len(month_counts)
+    )
+    variable_cost = np.bincount(
+        month_index, weights=np.where(expense_df['is_variable_cost'].to_numpy(), amount, 0), minlength=len(month_counts)
+    )
 
-    # 月別集計
     monthly_summary = pd.DataFrame({
-        'fixed_cost': -fixed_cost_df.groupby('year_month')['amount'].sum(),  # 支出は負の値なので正に変換
-        'variable_cost': -variable_cost_df.groupby('year_month')['amount'].sum(),  # 支出は負の値なので正に変換
-    }).reset_index()
+        'year_month': np.flatnonzero(has_data).astype('int32') + oldest_month,
+        'fixed_cost': -fixed_cost[has_data].astype('int32'),
+        'variable_cost': -variable_cost[has_data].astype('int32')
+    })
 
     # 合計列を追加
     monthly_summary['total_cost'] = monthly_summary['fixed_cost'] + monthly_summary['variable_cost']
-    monthly_summary['fixed_cost_ratio'] = (monthly_summary['fixed_cost'] / monthly_summary['total_cost'] * 100).round(1)
-    monthly_summary['variable_cost_ratio'] = (monthly_summary['variable_cost'] / monthly_summary['total_cost'] * 100).round(1)
-
-    return monthly_summary
-
-def get_kakeibo_data_range(preprocessed_kakeibo_df: pd.DataFrame) -> tuple[datetime, datetime]:
-    """
-    家計簿データの日付範囲を取得する
 
-    :param preprocessed_kakeibo_df: 前処理済みの家計簿データ
-    :type preprocessed_kakeibo_df: pd.DataFrame
-    :return: 最古の日付, 最新の日付のタプル
-    :rtype: tuple[datetime, datetime]
-    """
+    # 比率は合計の逆数（%換算）を1回だけ求めて掛ける（合計が0の月は0%とする）
+    total_cost = monthly_summary['total_cost'].to_numpy(np.float64)
+    percent_per_yen = np.divide(100.0, total_cost, out=np.zeros_like(total_cost), where=total_cost > 0)
+    monthly_summary['fixed_cost_ratio'] = (monthly_summary['fixed_cost'].to_numpy() * percent_per_yen).round(1)
+    monthly_summary['variable_cost_ratio'] = (monthly_summary['variable_cost'].to_numpy() * percent_per_yen).round(1)
 
-    # date列の最小値と最大値を取得
-    oldest_date: datetime = preprocessed_kakeibo_df['date'].min()
-    newest_date: datetime = preprocessed_kakeibo_df['date'].max()
-
-    return oldest_date, newest_date
+    return monthly_summary
 
 def display_cost_summaries(monthly_cost_summary: pd.DataFrame, preprocessed_kakeibo_df: pd.DataFrame):
     """固定費と変動費の集計結果を表示する
@@ -137,7 +80,7 @@ def display_cost_summaries(monthly_cost_summary: pd.DataFrame, preprocessed_kake
     variable_cost_ratio = round(total_variable_cost / total_cost * 100, 1) if total_cost > 0 else 0
 
     # データ期間情報を取得
-    start_date, end_date = get_kakeibo_data_range(preprocessed_kakeibo_df)
+    start_date, end_date = kakeibo_pipeline.get_kakeibo_data_range(preprocessed_kakeibo_df)
     months_count = len(monthly_cost_summary)
 
     # 指標を3列で表示
@@ -147,51 +90,30 @@ def display_cost_summaries(monthly_cost_summary: pd.DataFrame, preprocessed_kake
         # 固定費関連の指標
         st.markdown("### 💰 固定費")
 
-        fixed_metrics = [
+        metric_cards.display_metric_cards([
             {"title": "総固定費", "value": total_fixed_cost},
             {"title": "月平均固定費", "value": monthly_avg['fixed_cost']},
-            {"title": "固定費率", "value": f"{fixed_cost_ratio}%", "is_ratio": True}
-        ]
-
-        for metric in fixed_metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            if metric.get('is_ratio'):
-                con.markdown(f"### :blue[{metric['value']}]")
-            else:
-                con.markdown(f"### :blue[¥ {metric['value']:,.0f}]")
+            {"title": "固定費率", "value": f"{fixed_cost_ratio}%"}
+        ], color="blue")
 
     with col2:
         # 変動費関連の指標
         st.markdown("### 🛒 変動費")
 
-        variable_metrics = [
+        metric_cards.display_metric_cards([
             {"title": "総変動費", "value": total_variable_cost},
             {"title": "月平均変動費", "value": monthly_avg['variable_cost']},
-            {"title": "変動費率", "value": f"{variable_cost_ratio}%", "is_ratio": True}
-        ]
-
-        for metric in variable_metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            if metric.get('is_ratio'):
-                con.markdown(f"### :green[{metric['value']}]")
-            else:
-                con.markdown(f"### :green[¥ {metric['value']:,.0f}]")
+            {"title": "変動費率", "value": f"{variable_cost_ratio}%"}
+        ], color="green")
 
     with col3:
         # 合計関連の指標
         st.markdown("### 📊 合計")
 
-        total_metrics = [
+        metric_cards.display_metric_cards([
             {"title": "総支出", "value": total_cost},
             {"title": "月平均支出", "value": monthly_avg['total_cost']}
-        ]
-
-        for metric in total_metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            con.markdown(f"### :orange[¥ {metric['value']:,.0f}]")
+        ], color="orange")
 
     # データ期間情報を表示
     st.info(f"📅 **データ期間:** {start_date.strftime('%Y/%m/%d')} 〜 {end_date.strftime('%Y/%m/%d')} （{months_count}ヶ月）")
@@ -202,38 +124,29 @@ def plot_monthly_fixed_variable_costs(monthly_cost_summary: pd.DataFrame):
     :param monthly_cost_summary: 月別の固定費・変動費集計データ
     :type monthly_cost_summary: pd.DataFrame
     """
-    # year_monthをstring型に変換してソート
-    df = monthly_cost_summary.copy()
-    df['year_month_str'] = df['year_month'].astype(str)
-    df['year_month_dt'] = df['year_month'].dt.to_timestamp()
-    df = df.sort_values('year_month_dt')
+    import altair as alt
+
+    # year_monthを日付・文字列に変換してソート（assignは元のデータを変更しない）
+    year_month_dt = kakeibo_pipeline.year_month_to_timestamp(monthly_cost_summary['year_month'])
+    df = monthly_cost_summary.assign(
+        year_month_str=year_month_dt.dt.strftime('%Y-%m'),
+        year_month_dt=year_month_dt
+    ).sort_values('year_month_dt')
 
     # 積み上げ棒グラフ用のデータを準備
-    stacked_data = pd.melt(
-        df,
-        id_vars=['year_month_str', 'year_month_dt'],
-        value_vars=['fixed_cost', 'variable_cost'],
-        var_name='cost_type',
-        value_name='amount'
+    # 縦持ちへの変換はPython側で行わず、グラフ側（transform_fold）で行う。カラム名はそのまま凡例の表示名にする
+    cost_data = df[['year_month_str', 'year_month_dt', 'fixed_cost', 'variable_cost']].rename(
+        columns={'fixed_cost': '固定費', 'variable_cost': '変動費'}
     )
 
-    # カテゴリ名をわかりやすく変更
-    category_mapping = {
-        'fixed_cost': '固定費',
-        'variable_cost': '変動費'
-    }
-
-    stacked_data['cost_type'] = stacked_data['cost_type'].map(category_mapping)
-
-    # 積み上げ順序用の数値を追加（固定費を0、変動費を1として固定費が下になるように）
-    order_mapping = {
-        '固定費': 0,
-        '変動費': 1
-    }
-    stacked_data['order'] = stacked_data['cost_type'].map(order_mapping)
-
     # 積み上げ棒グラフ作成
-    bar_chart = alt.Chart(stacked_data).mark_bar().encode(
+    bar_chart = alt.Chart(cost_data).transform_fold(
+        ['固定費', '変動費'],
+        as_=['cost_type', 'amount']
+    ).transform_calculate(
+        # 積み上げ順序用の数値（固定費を0、変動費を1として固定費が下になるように）
+        order="datum.cost_type === '固定費' ? 0 : 1"
+    ).mark_bar().encode(
         x=alt.X('year_month_str:N', title='年月', sort=alt.EncodingSortField(field='year_month_dt')),
         y=alt.Y('amount:Q', title='金額（円）', stack=True),
         color=alt.Color(
@@ -264,31 +177,26 @@ def plot_fixed_variable_cost_ratio(monthly_cost_summary: pd.DataFrame):
     :param monthly_cost_summary: 月別の固定費・変動費集計データ
     :type monthly_cost_summary: pd.DataFrame
     """
-    # year_monthをstring型に変換してソート
-    df = monthly_cost_summary.copy()
-    df['year_month_str'] = df['year_month'].astype(str)
-    df['year_month_dt'] = df['year_month'].dt.to_timestamp()
-    df = df.sort_values('year_month_dt')
+    import altair as alt
+
+    # year_monthを日付・文字列に変換してソート（assignは元のデータを変更しない）
+    year_month_dt = kakeibo_pipeline.year_month_to_timestamp(monthly_cost_summary['year_month'])
+    df = monthly_cost_summary.assign(
+        year_month_str=year_month_dt.dt.strftime('%Y-%m'),
+        year_month_dt=year_month_dt
+    ).sort_values('year_month_dt')
 
     # 比率のグラフ用データを準備
-    ratio_data = pd.melt(
-        df,
-        id_vars=['year_month_str', 'year_month_dt'],
-        value_vars=['fixed_cost_ratio', 'variable_cost_ratio'],
-        var_name='ratio_type',
-        value_name='percentage'
+    # 縦持ちへの変換はPython側で行わず、グラフ側（transform_fold）で行う。カラム名はそのまま凡例の表示名にする
+    ratio_data = df[['year_month_str', 'year_month_dt', 'fixed_cost_ratio', 'variable_cost_ratio']].rename(
+        columns={'fixed_cost_ratio': '固定費率', 'variable_cost_ratio': '変動費率'}
     )
 
-    # カテゴリ名をわかりやすく変更
-    ratio_mapping = {
-        'fixed_cost_ratio': '固定費率',
-        'variable_cost_ratio': '変動費率'
-    }
-
-    ratio_data['ratio_type'] = ratio_data['ratio_type'].map(ratio_mapping)
-
     # 折れ線グラフ作成
-    ratio_chart = alt.Chart(ratio_data).mark_line(
+    ratio_chart = alt.Chart(ratio_data).transform_fold(
+        ['固定費率', '変動費率'],
+        as_=['ratio_type', 'percentage']
+    ).mark_line(
         point={
             'filled': True,
             'size': 80
@@ -328,17 +236,18 @@ def main():
     st.title("💰 固定費・変動費分析")
 
     with st.spinner("家計簿データを取得中..."):
-        # S3からデータを取得
-        kakeibo_data: pd.DataFrame = s3_utils.read_csv_files_from_s3(bucket_name=S3_BUCKET_NAME, prefix=S3_PREFIX)
+        # S3からデータを取得（固定費・変動費のフラグは共通の前処理で作成済み）
+        preprocessed_kakeibo_data: pd.DataFrame = kakeibo_pipeline.load_preprocessed_kakeibo_data()
 
-    # 家計簿データの前処理
-    preprocessed_kakeibo_data: pd.DataFrame = preprocess_kakeibo_data(kakeibo_data)
+    if preprocessed_kakeibo_data is None or preprocessed_kakeibo_data.empty:
+        st.warning("家計簿データが見つかりませんでした。")
+        return
 
     # 月単位のデータ集計
     monthly_cost_summary: pd.DataFrame = summarize_monthly_fixed_variable_costs(preprocessed_kakeibo_data)
 
     # 家計簿データの期間を表示
-    start_date, end_date = get_kakeibo_data_range(preprocessed_kakeibo_data)
+    start_date, end_date = kakeibo_pipeline.get_kakeibo_data_range(preprocessed_kakeibo_data)
 
     # 設定ファイルから固定費カテゴリを表示
     st.info(f"**固定費の分類基準:** {', '.join(config.FIXED_COST_CATEGORIES)}")
@@ -360,9 +269,10 @@ def main():
     st.header("📋 詳細データ")
     with st.expander("月別固定費・変動費データ", expanded=False):
         # データを見やすく整形
-        display_df = monthly_cost_summary.copy()
-        display_df['year_month'] = display_df['year_month'].astype(str)
-        display_df = display_df.rename(columns={
+        # 表示用の年月だけを差し替える（集計結果はコピーしない）
+        display_df = monthly_cost_summary.assign(
+            year_month=kakeibo_pipeline.year_month_to_timestamp(monthly_cost_summary['year_month']).dt.strftime('%Y-%m')
+        ).rename(columns={
             'year_month': '年月',
             'fixed_cost': '固定費（円）',
             'variable_cost': '変動費（円）',
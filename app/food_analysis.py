@@ -1,97 +1,11 @@
 import streamlit as st
 import pandas as pd
-import s3_utils
-import os
-from datetime import datetime, timedelta
-import altair as alt
-from dotenv import load_dotenv
+import kakeibo_pipeline
+import metric_cards
 import numpy as np
+# altairは読み込みに時間がかかるため、グラフを描画する関数の中で読み込む（食費データがない場合などは読み込まない）
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
-
-S3_BUCKET_NAME = os.environ["S3_BUCKET_NAME"]
-S3_PREFIX = os.environ["S3_PREFIX"]
-
-def preprocess_kakeibo_data(kakeibo_df: pd.DataFrame) -> pd.DataFrame:
-    """家計簿データを前処理する
-    :param kakeibo_df: 家計簿データ
-    :type kakeibo_df: pd.DataFrame
-    :return: 前処理済みの家計簿データ
-    :rtype: pd.DataFrame
-    """
-
-    df = kakeibo_df.copy()
-
-    # カラム名を英語に変換して扱いやすくする
-    columns_mapping = {
-        "計算対象": "is_target",
-        "日付": "date",
-        "内容": "description",
-        "金額（円）": "amount",
-        "保有金融機関": "financial_institution",
-        "大項目": "major_category",
-        "中項目": "minor_category",
-        "メモ": "memo",
-        "振替": "is_transfer",
-        "ID": "id"
-    }
-    df = df.rename(columns=columns_mapping)
-
-    # データ操作や集計をしやすくするために日付をdatetime型に変換
-    df['date'] = pd.to_datetime(df['date'])
-
-    # 計算対象と振替のフラグを数値型に変換
-    df['is_target'] = df['is_target'].astype(int)
-    df['is_transfer'] = df['is_transfer'].astype(int)
-
-    # 食費フラグの作成
-    target_minor_categories = [
-        '食費-会',
-        '食費-家・外',
-        '食費-家・中',
-        '食費-個・外'
-    ]
-    df['is_food'] = df['minor_category'].isin(target_minor_categories)
-
-    # 計算対象外のものは削除
-    df = df[df['is_target'] == 1]
-
-    # 振替対象のものは削除
-    df = df[df['is_transfer'] == 0]
-
-    return df
-
-def get_weekday_count_in_month(year: int, month: int) -> int:
-    """指定された年月の平日数を算出する
-
-    :param year: 年
-    :type year: int
-    :param month: 月
-    :type month: int
-    :return: 平日数（月曜日〜金曜日）
-    :rtype: int
-    """
-    # 月の最初の日
-    start_date = datetime(year, month, 1)
-
-    # 次の月の最初の日を取得して、1日引いて月末を算出
-    if month == 12:
-        end_date = datetime(year + 1, 1, 1) - timedelta(days=1)
-    else:
-        end_date = datetime(year, month + 1, 1) - timedelta(days=1)
-
-    weekday_count = 0
-    current_date = start_date
-
-    while current_date <= end_date:
-        # 平日（月曜日=0 〜 金曜日=4）をカウント
-        if current_date.weekday() < 5:
-            weekday_count += 1
-        current_date += timedelta(days=1)
-
-    return weekday_count
-
+@st.cache_data(ttl="1h")
 def summarize_monthly_food_data(preprocessed_kakeibo_df: pd.DataFrame) -> pd.DataFrame:
     """月単位の食費データを小項目別に集計する
 
@@ -100,34 +14,33 @@ def summarize_monthly_food_data(preprocessed_kakeibo_df: pd.DataFrame) -> pd.Dat
     :return: 月別集計した食費データ
     :rtype: pd.DataFrame
     """
-    df = preprocessed_kakeibo_df.copy()
+    df = preprocessed_kakeibo_df
 
-    # 食費のみを抽出
-    food_df = df[df['is_food']].copy()
+    # 食費のみを抽出（抽出結果は新しいDataFrameのため、元のデータをコピーする必要はない）
+    food_df = df[df['is_food']]
 
     # 月別で集計するため、年月のカラムを追加
-    food_df['year_month'] = food_df['date'].dt.to_period('M')
-
-    # 小項目別の月別集計
-    monthly_food_summary = food_df.groupby(['year_month', 'minor_category'])['amount'].sum().reset_index()
+    # 年月は1970年1月からの月数（int32）で扱い、Period型を作らない
+    food_df = food_df.assign(year_month=kakeibo_pipeline.to_year_month(food_df['date']))
 
+    # 小項目別の月別集計を、月別・小項目別のマトリックスとして一度に作成する
     # 支出は負の値なので正に変換
-    monthly_food_summary['amount'] = -monthly_food_summary['amount']
-
-    # ピボットテーブルで月別・小項目別のマトリックスを作成
-    pivot_summary = monthly_food_summary.pivot(index='year_month', columns='minor_category', values='amount').fillna(0)
+    pivot_summary = pd.crosstab(
+        food_df['year_month'],
+        food_df['minor_category'],
+        values=-food_df['amount'],
+        aggfunc='sum'
+    ).fillna(0).astype('int32')  # 月ごとの金額はint32に収まる
 
-    # カラム名を整理（存在する小項目のみ）
-    food_categories = [col for col in pivot_summary.columns if col is not None]
-
-    # DataFrameに戻す
-    result_df = pivot_summary.reset_index()
+    # DataFrameに戻す（crosstabで付いた列の名前（minor_category）は外す）
+    result_df = pivot_summary.rename_axis(columns=None).reset_index()
 
     # 合計列を追加
-    result_df['total_food'] = result_df[food_categories].sum(axis=1)
+    result_df['total_food'] = result_df[pivot_summary.columns].sum(axis=1)
 
     return result_df
 
+@st.cache_data(ttl="1h")
 def calculate_workday_food_average(preprocessed_kakeibo_df: pd.DataFrame) -> pd.DataFrame:
     """食費-会の平日あたり平均を算出する
 
@@ -136,26 +49,25 @@ def calculate_workday_food_average(preprocessed_kakeibo_df: pd.DataFrame) -> pd.
     :return: 月別の食費-会の平日あたり平均データ
     :rtype: pd.DataFrame
     """
-    df = preprocessed_kakeibo_df.copy()
+    df = preprocessed_kakeibo_df
 
     # 食費-会のみを抽出
-    work_food_df = df[(df['is_food']) & (df['minor_category'] == '食費-会')].copy()
+    work_food_df = df[(df['is_food']) & (df['minor_category'] == '食費-会')]
 
     # 月別で集計するため、年月のカラムを追加
-    work_food_df['year_month'] = work_food_df['date'].dt.to_period('M')
+    # 年月は1970年1月からの月数（int32）で扱い、Period型を作らない
+    work_food_df = work_food_df.assign(year_month=kakeibo_pipeline.to_year_month(work_food_df['date']))
 
     # 月別の食費-会合計を算出
     monthly_work_food = work_food_df.groupby('year_month')['amount'].sum().reset_index()
 
     # 支出は負の値なので正に変換
-    monthly_work_food['amount'] = -monthly_work_food['amount']
+    monthly_work_food['amount'] = (-monthly_work_food['amount']).astype('int32')
 
-    # 各月の平日数を算出
-    monthly_work_food['year'] = monthly_work_food['year_month'].dt.year
-    monthly_work_food['month'] = monthly_work_food['year_month'].dt.month
-    monthly_work_food['weekday_count'] = monthly_work_food.apply(
-        lambda row: get_weekday_count_in_month(row['year'], row['month']), axis=1
-    )
+    # 各月の平日数（月曜日〜金曜日）を算出
+    # 月初から翌月初までの平日数をnp.busday_countで全ての月について一度に数える
+    month_starts = monthly_work_food['year_month'].to_numpy().astype('datetime64[M]')
+    monthly_work_food['weekday_count'] = np.busday_count(month_starts, month_starts + 1).astype('int32')
 
     # 平日あたり平均を算出
     monthly_work_food['daily_average'] = monthly_work_food['amount'] / monthly_work_food['weekday_count']
@@ -163,21 +75,6 @@ def calculate_workday_food_average(preprocessed_kakeibo_df: pd.DataFrame) -> pd.
 
     return monthly_work_food[['year_month', 'amount', 'weekday_count', 'daily_average']]
 
-def get_kakeibo_data_range(preprocessed_kakeibo_df: pd.DataFrame) -> tuple[datetime, datetime]:
-    """
-    家計簿データの日付範囲を取得する
-
-    :param preprocessed_kakeibo_df: 前処理済みの家計簿データ
-    :type preprocessed_kakeibo_df: pd.DataFrame
-    :return: 最古の日付, 最新の日付のタプル
-    :rtype: tuple[datetime, datetime]
-    """
-    # date列の最小値と最大値を取得
-    oldest_date: datetime = preprocessed_kakeibo_df['date'].min()
-    newest_date: datetime = preprocessed_kakeibo_df['date'].max()
-
-    return oldest_date, newest_date
-
 def display_food_summaries(monthly_food_summary: pd.DataFrame, workday_food_average: pd.DataFrame, preprocessed_kakeibo_df: pd.DataFrame):
     """食費の集計結果を表示する
 
@@ -205,7 +102,7 @@ def display_food_summaries(monthly_food_summary: pd.DataFrame, workday_food_aver
         total_weekdays = 0
 
     # データ期間情報を取得
-    start_date, end_date = get_kakeibo_data_range(preprocessed_kakeibo_df)
+    start_date, end_date = kakeibo_pipeline.get_kakeibo_data_range(preprocessed_kakeibo_df)
     months_count = len(monthly_food_summary)
 
     # 指標を2行3列で表示
@@ -215,102 +112,39 @@ def display_food_summaries(monthly_food_summary: pd.DataFrame, workday_food_aver
     with col1:
         # 総食費関連の指標
         st.markdown("### 🍽️ 総食費")
-
-        food_metrics = [
+        metric_cards.display_metric_cards([
             {"title": "総食費", "value": total_food_cost},
             {"title": "月平均食費", "value": monthly_avg_food}
-        ]
-
-        for metric in food_metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            con.markdown(f"### :green[¥ {metric['value']:,.0f}]")
+        ], color="green")
 
     with col2:
         # 食費-会
-        category_name = '食費-会'
-        st.markdown(f"### ☕ {category_name}")
-
-        work_food_metrics = [
+        st.markdown("### ☕ 食費-会")
+        metric_cards.display_metric_cards([
             {"title": "総額", "value": total_work_food},
             {"title": "平日あたり平均", "value": avg_daily_work_food}
-        ]
+        ], color="blue")
 
-        for metric in work_food_metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            con.markdown(f"### :blue[¥ {metric['value']:,.0f}]")
+    # 食費-家・外、食費-家・中、食費-個・外
+    for col, icon, category_name in [(col3, "🍔", '食費-家・外'), (col4, "🏠", '食費-家・中'), (col5, "🚶", '食費-個・外')]:
+        with col:
+            st.markdown(f"### {icon} {category_name}")
 
-    with col3:
-        # 食費-家・外
-        category_name = '食費-家・外'
-        st.markdown(f"### 🍔 {category_name}")
-        
-        cat_total = monthly_food_summary[category_name].sum() if category_name in monthly_food_summary.columns else 0
-        cat_avg = monthly_food_summary[category_name].mean() if category_name in monthly_food_summary.columns else 0
-        
-        metrics = [
-            {"title": "総額", "value": cat_total},
-            {"title": "月平均", "value": cat_avg}
-        ]
-
-        for metric in metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            con.markdown(f"### :blue[¥ {metric['value']:,.0f}]")
-
-    with col4:
-        # 食費-家・中
-        category_name = '食費-家・中'
-        st.markdown(f"### 🏠 {category_name}")
-        
-        cat_total = monthly_food_summary[category_name].sum() if category_name in monthly_food_summary.columns else 0
-        cat_avg = monthly_food_summary[category_name].mean() if category_name in monthly_food_summary.columns else 0
-        
-        metrics = [
-            {"title": "総額", "value": cat_total},
-            {"title": "月平均", "value": cat_avg}
-        ]
+            cat_total = monthly_food_summary[category_name].sum() if category_name in monthly_food_summary.columns else 0
+            cat_avg = monthly_food_summary[category_name].mean() if category_name in monthly_food_summary.columns else 0
 
-        for metric in metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            con.markdown(f"### :blue[¥ {metric['value']:,.0f}]")
-
-    with col5:
-        # 食費-個・外
-        category_name = '食費-個・外'
-        st.markdown(f"### 🚶 {category_name}")
-        
-        cat_total = monthly_food_summary[category_name].sum() if category_name in monthly_food_summary.columns else 0
-        cat_avg = monthly_food_summary[category_name].mean() if category_name in monthly_food_summary.columns else 0
-        
-        metrics = [
-            {"title": "総額", "value": cat_total},
-            {"title": "月平均", "value": cat_avg}
-        ]
-
-        for metric in metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            con.markdown(f"### :blue[¥ {metric['value']:,.0f}]")
+            metric_cards.display_metric_cards([
+                {"title": "総額", "value": cat_total},
+                {"title": "月平均", "value": cat_avg}
+            ], color="blue")
 
     with col6:
         # その他の指標
         st.markdown("### 📊 その他")
-
-        other_metrics = [
-            {"title": "総平日数", "value": f"{total_weekdays}日", "is_count": True},
-            {"title": "食費-会の割合", "value": f"{(total_work_food/total_food_cost*100):.1f}%" if total_food_cost > 0 else "0%", "is_ratio": True}
-        ]
-
-        for metric in other_metrics:
-            con = st.container(border=True)
-            con.markdown(f"**{metric['title']}**")
-            if metric.get('is_count') or metric.get('is_ratio'):
-                con.markdown(f"### :orange[{metric['value']}]")
-            else:
-                con.markdown(f"### :orange[¥ {metric['value']:,.0f}]")
+        metric_cards.display_metric_cards([
+            {"title": "総平日数", "value": f"{total_weekdays}日"},
+            {"title": "食費-会の割合", "value": f"{(total_work_food/total_food_cost*100):.1f}%" if total_food_cost > 0 else "0%"}
+        ], color="orange")
 
     # データ期間情報を表示
     st.info(f"📅 **データ期間:** {start_date.strftime('%Y/%m/%d')} 〜 {end_date.strftime('%Y/%m/%d')} （{months_count}ヶ月）")
@@ -321,19 +155,14 @@ def plot_monthly_food_trend(monthly_food_summary: pd.DataFrame):
     :param monthly_food_summary: 月別の食費集計データ
     :type monthly_food_summary: pd.DataFrame
     """
-    # year_monthをstring型に変換してソート
-    df = monthly_food_summary.copy()
-
-    # year_monthがPeriod型でない場合は変換
-    if not pd.api.types.is_period_dtype(df['year_month']):
-        df['year_month'] = pd.to_period(df['year_month'], freq='M')
-
-    # タイムスタンプに変換してからソート
-    df['year_month_dt'] = df['year_month'].dt.to_timestamp()
-    df = df.sort_values('year_month_dt')
+    import altair as alt
 
-    # ソート後にstring型に変換
-    df['year_month_str'] = df['year_month'].astype(str)
+    # 集計結果をコピーせず、タイムスタンプ・文字列の年月を追加してからソート
+    year_month_dt = kakeibo_pipeline.year_month_to_timestamp(monthly_food_summary['year_month'])
+    df = monthly_food_summary.assign(
+        year_month_dt=year_month_dt,
+        year_month_str=year_month_dt.dt.strftime('%Y-%m')
+    ).sort_values('year_month_dt')
 
     # 食費の小項目カラムを取得（year_month, year_month_str, year_month_dt, total_food以外）
     food_categories = [col for col in df.columns if col not in ['year_month', 'year_month_str', 'year_month_dt', 'total_food']]
@@ -342,16 +171,8 @@ def plot_monthly_food_trend(monthly_food_summary: pd.DataFrame):
     food_categories = sorted(food_categories)
 
     # 積み上げ棒グラフ用のデータを準備
-    stacked_data = pd.melt(
-        df,
-        id_vars=['year_month_str', 'year_month_dt'],
-        value_vars=food_categories,
-        var_name='food_category',
-        value_name='amount'
-    )
-
-    # 0円のデータを除外（グラフを見やすくするため）
-    stacked_data = stacked_data[stacked_data['amount'] > 0]
+    # 縦持ちへの変換はPython側で行わず、グラフ側（transform_fold）で行う（送信するデータは月数×カラム数のまま）
+    stacked_data = df[['year_month_str', *food_categories]]
 
     # 年月の順序を明示的に定義（時系列順）
     month_order = df['year_month_str'].tolist()
@@ -360,7 +181,13 @@ def plot_monthly_food_trend(monthly_food_summary: pd.DataFrame):
     color_palette = ['#ff7f7f', '#87ceeb', '#98d982', '#ffb347', '#dda0dd', '#f0e68c']
 
     # 積み上げ棒グラフ作成
-    bar_chart = alt.Chart(stacked_data).mark_bar().encode(
+    bar_chart = alt.Chart(stacked_data).transform_fold(
+        food_categories,
+        as_=['food_category', 'amount']
+    ).transform_filter(
+        # 0円のデータを除外（グラフを見やすくするため）
+        alt.datum.amount > 0
+    ).mark_bar().encode(
         x=alt.X(
             'year_month_str:N',
             title='年月',
@@ -398,14 +225,13 @@ def plot_workday_food_average_trend(workday_food_average: pd.DataFrame):
         st.warning("食費-会のデータがありません。")
         return
 
-    df = workday_food_average.copy()
+    import altair as alt
 
     # year_monthでソートして、順序を保証
-    df = df.sort_values('year_month')
-
-    # year_monthをstring型に変換
-    df['year_month_str'] = df['year_month'].astype(str)
-    df['year_month_dt'] = df['year_month'].dt.to_timestamp()
+    # グラフのデータはブラウザに送信されるため、エンコードに使うカラムだけに絞る（年月は文字列のみ）
+    df = workday_food_average.assign(
+        year_month_str=kakeibo_pipeline.year_month_to_timestamp(workday_food_average['year_month']).dt.strftime('%Y-%m')
+    ).sort_values('year_month')[['year_month_str', 'amount', 'weekday_count', 'daily_average']]
 
     # 年月の順序を明示的に定義（時系列順）
     month_order = df['year_month_str'].tolist()
@@ -448,7 +274,10 @@ def plot_food_category_pie_chart(monthly_food_summary: pd.DataFrame):
     :param monthly_food_summary: 月別の食費集計データ
     :type monthly_food_summary: pd.DataFrame
     """
-    df = monthly_food_summary.copy()
+    import altair as alt
+
+    # 参照するだけなので、集計結果はコピーしない
+    df = monthly_food_summary
     
     # 食費の小項目カラムを取得
     food_categories = [col for col in df.columns if col not in ['year_month', 'year_month_str', 'year_month_dt', 'total_food']]
@@ -509,41 +338,44 @@ def main():
     # 家計簿データの取得
     ###############################################################
     with st.spinner("家計簿データを取得中..."):
-        # S3からデータを取得
-        kakeibo_data: pd.DataFrame = s3_utils.read_csv_files_from_s3(bucket_name=S3_BUCKET_NAME, prefix=S3_PREFIX)
+        # S3からデータを取得（食費フラグは共通の前処理で作成済み）
+        preprocessed_kakeibo_data: pd.DataFrame = kakeibo_pipeline.load_preprocessed_kakeibo_data()
 
-    ###############################################################
-    # 家計簿データの前処理
-    ###############################################################
-    preprocessed_kakeibo_data: pd.DataFrame = preprocess_kakeibo_data(kakeibo_data)
+    if preprocessed_kakeibo_data is None or preprocessed_kakeibo_data.empty:
+        st.warning("家計簿データが見つかりませんでした。")
+        return
 
     ###############################################################
     # UIによる期間指定とフィルタリング
     ###############################################################
-    preprocessed_kakeibo_data['year_month_str'] = preprocessed_kakeibo_data['date'].dt.strftime('%Y-%m')
-    available_months = sorted(preprocessed_kakeibo_data['year_month_str'].unique())
+    # 共通の前処理済みのデータは他のページと共有しているため、カラムを追加せずに年月を求める
+    # 年月は1970年1月からの月数で比較し、文字列への変換は選択肢の表示だけで行う
+    year_month = kakeibo_pipeline.to_year_month(preprocessed_kakeibo_data['date'])
+    available_months = np.unique(year_month).tolist()
 
     if available_months:
         st.header("🗓️ 期間指定")
         start_month, end_month = st.select_slider(
             "表示する期間を選択してください",
             options=available_months,
-            value=(available_months[0], available_months[-1])
+            value=(available_months[0], available_months[-1]),
+            format_func=lambda month: str(np.datetime64(month, 'M'))
         )
         
         # Pandasによるフィルタリング
+        # 抽出結果は新しいDataFrameで、以降の処理でも変更しないため、コピーは作らない
         filtered_kakeibo_data = preprocessed_kakeibo_data[
-            (preprocessed_kakeibo_data['year_month_str'] >= start_month) & 
-            (preprocessed_kakeibo_data['year_month_str'] <= end_month)
-        ].copy()
+            (year_month >= start_month) & 
+            (year_month <= end_month)
+        ]
     else:
-        filtered_kakeibo_data = preprocessed_kakeibo_data.copy()
+        filtered_kakeibo_data = preprocessed_kakeibo_data
 
     ###############################################################
     # 食費データがあるかチェック
     ###############################################################
-    food_data = filtered_kakeibo_data[filtered_kakeibo_data['is_food']]
-    if food_data.empty:
+    # 食費の行を抽出せず、フラグだけで有無を確認する
+    if not filtered_kakeibo_data['is_food'].any():
         st.warning("指定された期間の食費データが見つかりません。")
         return
     
@@ -585,8 +417,10 @@ def main():
 
     with st.expander("月別食費データ", expanded=False):
         # データを見やすく整形
-        display_df = monthly_food_summary.copy()
-        display_df['year_month'] = display_df['year_month'].astype(str)
+        # 表示用の年月だけを差し替える（集計結果はコピーしない）
+        display_df = monthly_food_summary.assign(
+            year_month=kakeibo_pipeline.year_month_to_timestamp(monthly_food_summary['year_month']).dt.strftime('%Y-%m')
+        )
 
         # カラム名を日本語に変更
         column_rename = {'year_month': '年月', 'total_food': '食費合計（円）'}
@@ -600,9 +434,9 @@ def main():
     if not workday_food_average.empty:
         with st.expander("食費-会の平日あたり平均データ", expanded=False):
             # データを見やすく整形
-            workday_display_df = workday_food_average.copy()
-            workday_display_df['year_month'] = workday_display_df['year_month'].astype(str)
-            workday_display_df = workday_display_df.rename(columns={
+            workday_display_df = workday_food_average.assign(
+                year_month=kakeibo_pipeline.year_month_to_timestamp(workday_food_average['year_month']).dt.strftime('%Y-%m')
+            ).rename(columns={
                 'year_month': '年月',
                 'amount': '食費-会 月合計（円）',
                 'weekday_count': '平日数（日）',
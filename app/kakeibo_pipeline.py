@@ -0,0 +1,176 @@
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import streamlit as st
+from dotenv import load_dotenv
+import s3_utils
+import config
+
+# 各分析ページで共通の家計簿データの取得・前処理
+# キャッシュ対象の関数をこのモジュールにまとめることで、ページ間でキャッシュのエントリが共有される
+
+# .envファイルから環境変数を読み込む
+load_dotenv()
+
+S3_BUCKET_NAME = os.environ["S3_BUCKET_NAME"]
+S3_PARQUET_PREFIX = os.environ["S3_PARQUET_PREFIX"]
+
+# 分析ページで使用するカラム
+# 計算対象・振替のフラグは読み込み時の行の絞り込みにだけ使うため、DataFrameには含めない
+ANALYSIS_COLUMNS = ("日付", "金額（円）", "大項目", "中項目")
+
+# 前処理済みの家計簿データをセッションに保持するキー
+SESSION_STATE_KEY = "preprocessed_kakeibo_data"
+
+# カラム名を英語に変換して扱いやすくするための対応表
+COLUMNS_MAPPING = {
+    "計算対象": "is_target",
+    "日付": "date",
+    "内容": "description",
+    "金額（円）": "amount",
+    "保有金融機関": "financial_institution",
+    "大項目": "major_category",
+    "中項目": "minor_category",
+    "メモ": "memo",
+    "振替": "is_transfer",
+    "ID": "id"
+}
+
+def load_preprocessed_kakeibo_data() -> pd.DataFrame | None:
+    """各分析ページで共通の前処理を済ませた家計簿データを取得する
+
+    S3上のファイル一覧が変わっていなければ、キャッシュ済みの前処理結果を返す。
+    st.cache_dataは呼び出しのたびに結果を複製するため、同じセッションでは前回取得したDataFrameをそのまま返す
+    （ページ間の移動や再実行でデータ全体を複製し直さない）。返したDataFrameは変更しないこと。
+
+    :return: 前処理済みの家計簿データ
+    :rtype: pd.DataFrame | None
+    """
+
+    parquet_files = s3_utils.list_parquet_files(S3_BUCKET_NAME, S3_PARQUET_PREFIX)
+
+    # ファイル一覧が同じであれば、セッションに保持している前処理結果を使う
+    cached = st.session_state.get(SESSION_STATE_KEY)
+    if cached is not None and cached[0] == parquet_files:
+        return cached[1]
+
+    # 読み込みに失敗した場合は例外が送出されるため、セッションには成功した結果だけが保持される
+    kakeibo_df = preprocess_kakeibo_files(parquet_files)
+    st.session_state[SESSION_STATE_KEY] = (parquet_files, kakeibo_df)
+
+    return kakeibo_df
+
+@st.cache_data(persist="disk", max_entries=4)
+def preprocess_kakeibo_files(parquet_files: tuple[tuple[str, int, int], ...]) -> pd.DataFrame | None:
+    """S3上のParquetファイルから分析対象の家計簿データを読み込み、各分析ページで共通の前処理を行う
+
+    - 計算対象外・振替対象のものの除外（読み込み時）
+    - 使用しないカラムの除外（読み込み時）
+    - カラム名を英語に変換
+    - 金額のダウンキャスト
+    - 大項目のcategory型への変換
+    - 収入・固定費・変動費・食費のフラグの作成
+
+    収支分析の収入区分（給与・賞与など）は収支分析のページで追加する。
+
+    結果はディスクにも保存されるため、アプリを再起動してもファイル一覧が変わっていなければS3から読み直さない。
+    S3からの読み込みに失敗した場合は例外を送出し、結果をキャッシュしない（次回の実行で読み直す）。
+
+    :param parquet_files: s3_utils.list_parquet_filesで取得したファイル一覧
+    :type parquet_files: tuple[tuple[str, int, int], ...]
+    :return: 前処理済みの家計簿データ
+    :rtype: pd.DataFrame | None
+    """
+
+    # 計算対象外・振替対象の行と、使用しないカラムはスキャン時に除外される
+    kakeibo_df = s3_utils.read_parquet_files_from_s3(parquet_files, columns=ANALYSIS_COLUMNS, target_only=True)
+    if kakeibo_df is None:
+        return None
+
+    # カラム名を英語に変換して扱いやすくする（読み込んだばかりのDataFrameなので、データはコピーしない）
+    df = rename_kakeibo_columns(kakeibo_df)
+
+    # 日付（datetime型）は読み込み時に型変換済み
+
+    # 1取引の金額はint32に収まるため、集計時のメモリ帯域を抑えるためにダウンキャストする
+    df['amount'] = df['amount'].astype('int32')
+
+    # 大項目は種類が少ないのでcategory型にし、文字列ではなくコードで比較する
+    df['major_category'] = df['major_category'].astype('category')
+
+    # 大項目の文字列の判定はカテゴリごとに1回だけ行い、コードで各行に割り当てる
+    # 欠損値のコード(-1)は末尾に追加したFalseを参照する
+    major_category_codes = df['major_category'].cat.codes.to_numpy()
+    major_categories = df['major_category'].cat.categories
+    is_income_category = np.append(major_categories == config.INCOME_CATEGORY, False)
+    is_fixed_cost_category = np.append(major_categories.isin(config.FIXED_COST_CATEGORIES), False)
+
+    # 「収入」カテゴリの分類
+    df['is_income'] = is_income_category[major_category_codes]
+
+    # 固定費と変動費の分類（設定ファイルに基づく）
+    # 収入でなく、固定費でもないものを変動費と分類
+    df['is_fixed_cost'] = is_fixed_cost_category[major_category_codes]
+    df['is_variable_cost'] = ~(is_income_category | is_fixed_cost_category)[major_category_codes]
+
+    # 食費フラグの作成（設定ファイルに基づく）
+    df['is_food'] = df['minor_category'].isin(config.FOOD_CATEGORIES).to_numpy(dtype=bool)
+
+    return df
+
+def rename_kakeibo_columns(kakeibo_df: pd.DataFrame) -> pd.DataFrame:
+    """家計簿データのカラム名を英語に変換する
+
+    カラム名だけを変えるため、データはコピーせずに元のDataFrameと共有する（元のデータを変更する場合は注意）。
+
+    :param kakeibo_df: 家計簿データ
+    :type kakeibo_df: pd.DataFrame
+    :return: カラム名を変換した家計簿データ
+    :rtype: pd.DataFrame
+    """
+
+    return kakeibo_df.rename(columns=COLUMNS_MAPPING, copy=False)
+
+def to_year_month(date: pd.Series) -> np.ndarray:
+    """日付を年月（1970年1月からの月数）に変換する
+
+    Periodよりも軽く、groupbyやbincountのキーとしてそのまま使える。
+
+    :param date: 日付
+    :type date: pd.Series
+    :return: 1970年1月からの月数（int32）
+    :rtype: np.ndarray
+    """
+
+    return date.to_numpy().astype('datetime64[M]').astype('int32')
+
+def year_month_to_timestamp(year_month: pd.Series) -> pd.Series:
+    """1970年1月からの月数で表した年月を、その月の初日の日時に変換する
+
+    :param year_month: 1970年1月からの月数
+    :type year_month: pd.Series
+    :return: 各月の初日の日時
+    :rtype: pd.Series
+    """
+
+    return pd.Series(
+        year_month.to_numpy().astype('datetime64[M]').astype('datetime64[ns]'),
+        index=year_month.index
+    )
+
+def get_kakeibo_data_range(preprocessed_kakeibo_df: pd.DataFrame) -> tuple[datetime, datetime]:
+    """
+    家計簿データの日付範囲を取得する
+
+    :param preprocessed_kakeibo_df: 前処理済みの家計簿データ
+    :type preprocessed_kakeibo_df: pd.DataFrame
+    :return: 最古の日付, 最新の日付のタプル
+    :rtype: tuple[datetime, datetime]
+    """
+
+    # date列の最小値と最大値を取得
+    oldest_date: datetime = preprocessed_kakeibo_df['date'].min()
+    newest_date: datetime = preprocessed_kakeibo_df['date'].max()
+
+    return oldest_date, newest_date
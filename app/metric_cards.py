@@ -0,0 +1,18 @@
+import streamlit as st
+
+# 各分析ページのサマリーで共通の指標カードの表示
+
+def display_metric_cards(metrics: list[dict], color: str):
+    """指標を枠付きのカードとして縦に並べて表示する
+
+    カードごとにタイトルと値を1回のmarkdownでまとめて描画する。
+
+    :param metrics: 指標（title: タイトル, value: 金額あるいは表示用の文字列, color: 指標ごとの文字色（省略可））のリスト
+    :type metrics: list[dict]
+    :param color: 値の文字色（Streamlitのmarkdownの色名）
+    :type color: str
+    """
+    for metric in metrics:
+        # 文字列はそのまま、数値は金額として表示する
+        value = metric['value'] if isinstance(metric['value'], str) else f"¥ {metric['value']:,.0f}"
+        st.container(border=True).markdown(f"**{metric['title']}**\n\n### :{metric.get('color', color)}[{value}]")
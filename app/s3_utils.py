@@ -1,75 +1,285 @@
+import os
+import io
 import streamlit as st
 import pandas as pd
-import s3fs
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as pads
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+# 家計簿CSVの各カラムの型（型推論を省き、ファイル間でスキーマを揃える）
+KAKEIBO_COLUMN_TYPES = {
+    "計算対象": pa.int8(),
+    "日付": pa.timestamp("s"),
+    "内容": pa.string(),
+    "金額（円）": pa.int64(),
+    "保有金融機関": pa.string(),
+    "大項目": pa.string(),
+    "中項目": pa.string(),
+    "メモ": pa.string(),
+    "振替": pa.int8(),
+    "ID": pa.string(),
+}
+
+# 家計簿CSVの読み込みオプション（Shift-JISのまま読み込み、カラムの型を指定する）
+KAKEIBO_CSV_READ_OPTIONS = pacsv.ReadOptions(encoding='shift-jis', use_threads=True, block_size=8 << 20)
+KAKEIBO_CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(
+    column_types=KAKEIBO_COLUMN_TYPES,
+    timestamp_parsers=["%Y/%m/%d", pacsv.ISO8601],
+    strings_can_be_null=True
+)
+
+# 計算対象かつ振替でない行の条件（スキャン時に行を絞り込むために使う）
+TARGET_ROW_FILTER = (pads.field("計算対象") == 1) & (pads.field("振替") == 0)
+
+# Parquetから読み込んだ文字列カラムのpandasでの型
+# Pythonの文字列オブジェクトを作らずにArrowのバッファのまま保持し、比較・isinもArrowのカーネルで行う
+KAKEIBO_PANDAS_TYPES = {pa.string(): pd.StringDtype("pyarrow")}
+
+# データセットの読み込み時に先読みするファイル数（pyarrowのデフォルトは4）
+# 月ごとの小さなファイルが多く、S3の往復時間が読み込み時間の大半を占めるため、同時に取得するファイルを増やす
+S3_FRAGMENT_READAHEAD = 32
+
+# マネーフォワードからエクスポートした家計簿CSVのファイル名の接頭辞
+CSV_FILE_NAME_PREFIX = "収入・支出詳細_"
 
 
 @st.cache_resource
-def get_s3fs() -> s3fs.S3FileSystem:
+def get_s3fs() -> pafs.S3FileSystem:
     """S3ファイルシステムのインスタンスを取得する
 
-    :return: S3FileSystemインスタンス
-    :rtype: s3fs.S3FileSystem
+    読み込みはC++側で行われるため、ファイルごとにPythonへ戻るs3fsよりもGILの影響を受けにくい。
+
+    :return: pyarrow.fs.S3FileSystemインスタンス
+    :rtype: pyarrow.fs.S3FileSystem
     """
 
     # 環境変数から認証情報を取得する場合
-    return s3fs.S3FileSystem(anon=False)
+    return pafs.S3FileSystem(region=os.getenv("AWS_REGION"))
+
+def list_csv_files(bucket_name: str, prefix: str) -> tuple[tuple[str, int, int], ...]:
+    """S3バケットのプレフィックス配下にある家計簿CSVファイルの一覧を取得する
 
-@st.cache_data(ttl="1h")
-def read_csv_files_from_s3(bucket_name: str, prefix: str) -> pd.DataFrame | None:
-    """S3バケットから家計簿CSVファイルの一覧を取得する
+    ListObjectsV2にプレフィックスを渡して一覧を取得するため、バケット全体を走査しない。
+    list_parquet_filesと同様に、パス・サイズ・更新日時の組を返す。
 
     :param bucket_name: S3バケット名
     :type bucket_name: str
     :param prefix: S3バケット内のプレフィックス
     :type prefix: str
-    :return: 家計簿データのDataFrame
-    :rtype: pd.DataFrame | None
+    :return: (パス（バケット名から始まる）, サイズ, 更新日時（ナノ秒）) のタプル
+    :rtype: tuple[tuple[str, int, int], ...]
+    """
+
+    s3 = get_s3fs()
+    file_infos = s3.get_file_info(pafs.FileSelector(f"{bucket_name}/{prefix}", recursive=True, allow_not_found=True))
+
+    return tuple(sorted(
+        (file_info.path, file_info.size, file_info.mtime_ns) for file_info in file_infos
+        if file_info.type == pafs.FileType.File
+        and file_info.base_name.startswith(CSV_FILE_NAME_PREFIX)
+        and file_info.extension == 'csv'
+    ))
+
+def read_kakeibo_csv_as_table(source) -> pa.Table:
+    """Shift-JISの家計簿CSVをArrowテーブルとして読み込む
+
+    カラムの型を指定することで型推論を省き、日付・フラグもこの時点で変換する。
+
+    :param source: CSVファイルの内容あるいはファイルオブジェクト
+    :type source: bytes | pa.NativeFile
+    :return: 家計簿データのArrowテーブル
+    :rtype: pa.Table
+    """
+
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    return pacsv.read_csv(source, read_options=KAKEIBO_CSV_READ_OPTIONS, convert_options=KAKEIBO_CSV_CONVERT_OPTIONS)
+
+def open_kakeibo_csv(file_content: bytes) -> pacsv.CSVStreamingReader:
+    """Shift-JISの家計簿CSVを先頭から少しずつ読み込むリーダーを作成する
+
+    ヘッダーと最初のブロックだけを読み込むため、カラムの確認やプレビューのためにファイル全体をパースせずに済む。
+
+    :param file_content: CSVファイルの内容
+    :type file_content: bytes
+    :return: CSVのストリーミングリーダー（schemaでカラムを、read_next_batchで先頭の行を取得できる）
+    :rtype: pacsv.CSVStreamingReader
+    """
+
+    return pacsv.open_csv(
+        io.BytesIO(file_content),
+        read_options=pacsv.ReadOptions(encoding='shift-jis', block_size=64 << 10),
+        convert_options=KAKEIBO_CSV_CONVERT_OPTIONS
+    )
+
+@st.cache_data(ttl="1m")
+def list_parquet_files(bucket_name: str, prefix: str) -> tuple[tuple[str, int, int], ...]:
+    """S3バケットのプレフィックス配下にあるParquetファイルの一覧を取得する
+
+    パス・サイズ・更新日時の組をファイル一覧として返し、データ読み込みのキャッシュのキーにする。
+    ファイルが追加・更新されたときだけ一覧が変わるため、変更がなければS3からデータを読み直さずに済む。
+
+    :param bucket_name: S3バケット名
+    :type bucket_name: str
+    :param prefix: Parquetデータセットのプレフィックス
+    :type prefix: str
+    :return: (パス, サイズ, 更新日時（ナノ秒）) のタプル
+    :rtype: tuple[tuple[str, int, int], ...]
     """
 
     s3 = get_s3fs()
-    csv_path = f"{bucket_name}/{prefix}/**/*.csv"
-    csv_files = s3.glob(csv_path)
-
-    # 各CSVファイルを読み込みDataFrameのリストに格納
-    kakeibo_lists: list[pd.DataFrame] = []
-    for csv_file in csv_files:
-        try:
-            # ファイル名を表示
-            filename = csv_file.split('/')[-1]
-            print(f"Reading file: {filename}")
-
-            # S3からファイルを読み込む
-            with s3.open(csv_file, 'rb') as f:
-                # CSVファイルを読み込み
-                df = pd.read_csv(f, encoding='shift-jis')
-
-                # ファイル名をDataFrameに追加
-                df['source_file'] = filename
-
-                # リストに追加
-                kakeibo_lists.append(df)
-
-        except Exception as e:
-            print(f"Error reading {csv_file}: {e}")
-
-    # 全てのDataFrameを結合
-    if kakeibo_lists:
-        return pd.concat(kakeibo_lists, ignore_index=True)
-    else:
-        print("No CSV files were read successfully.")
+    file_infos = s3.get_file_info(pafs.FileSelector(f"{bucket_name}/{prefix}", recursive=True, allow_not_found=True))
+
+    return tuple(sorted(
+        (file_info.path, file_info.size, file_info.mtime_ns) for file_info in file_infos
+        if file_info.type == pafs.FileType.File and file_info.extension == 'parquet'
+    ))
+
+def read_parquet_files_from_s3(parquet_files: tuple[tuple[str, int, int], ...], columns: tuple[str, ...], target_only: bool = False) -> pd.DataFrame | None:
+    """S3上のParquetファイルから家計簿データを取得する
+
+    必要なカラムのみを読み込むため、CSVを1ファイルずつ読み込むよりも転送量・パース量が少ない。
+    target_onlyを指定した場合は、計算対象外・振替の行をスキャン時に除外する（pandasに変換する行が減る）。
+    文字列カラムはobject型ではなくstring[pyarrow]型で返す。
+    キャッシュは呼び出し元（kakeibo_pipeline.preprocess_kakeibo_files）でファイル一覧ごとに行うため、ここではキャッシュしない。
+
+    :param parquet_files: list_parquet_filesで取得したファイル一覧
+    :type parquet_files: tuple[tuple[str, int, int], ...]
+    :param columns: 読み込むカラム
+    :type columns: tuple[str, ...]
+    :param target_only: 計算対象かつ振替でない行のみを読み込むかどうか
+    :type target_only: bool
+    :return: 家計簿データのDataFrame（ファイルあるいは対象の行がない場合はNone）
+    :rtype: pd.DataFrame | None
+    :raises OSError: S3からの読み込みに失敗した場合
+    """
+
+    if not parquet_files:
+        print("No parquet files were found.")
         return None
 
+    # 読み込みのエラーはNoneにせずそのまま送出する
+    # 呼び出し元のキャッシュ（st.cache_data）は例外をキャッシュしないため、一時的なS3のエラーでも次回の実行で読み直される
+    # 一覧は取得済みのため、データセット作成時にS3のリスト操作を繰り返さない
+    dataset = pads.dataset(
+        [path for path, _, _ in parquet_files],
+        format="parquet",
+        filesystem=get_s3fs()
+    )
+    row_filter = TARGET_ROW_FILTER if target_only else None
+    table = dataset.to_table(columns=list(columns), filter=row_filter, fragment_readahead=S3_FRAGMENT_READAHEAD)
+
+    if table.num_rows == 0:
+        print("No parquet files were read successfully.")
+        return None
+
+    return table.to_pandas(self_destruct=True, types_mapper=KAKEIBO_PANDAS_TYPES.get)
+
+def upload_parquet_to_s3(file_content: bytes, file_name: str, bucket_name: str, s3_key: str, filesystem: pafs.S3FileSystem | None = None):
+    """家計簿CSVをParquetに変換してS3にアップロードする
+
+    :param file_content: CSVファイルの内容
+    :type file_content: bytes
+    :param file_name: CSVファイル名（拡張子を.parquetに置き換えて保存する）
+    :type file_name: str
+    :param bucket_name: S3バケット名
+    :type bucket_name: str
+    :param s3_key: 保存先のキー（year=YYYY/month=M まで）
+    :type s3_key: str
+    :param filesystem: 書き込みに使うファイルシステム（Noneの場合はget_s3fsで取得する）
+    :type filesystem: pyarrow.fs.S3FileSystem | None
+    :return: 成功したかどうかと、保存先のパスあるいはエラーメッセージ
+    :rtype: tuple[bool, str]
+    """
+    try:
+        table = read_kakeibo_csv_as_table(file_content)
+    except Exception as e:
+        return False, str(e)
+
+    return write_parquet_to_s3(table, file_name, bucket_name, s3_key, filesystem)
+
+def write_parquet_to_s3(table: pa.Table, file_name: str, bucket_name: str, s3_key: str, filesystem: pafs.S3FileSystem | None = None):
+    """読み込み済みの家計簿データをParquetとしてS3に書き込む
+
+    :param table: read_kakeibo_csv_as_tableで読み込んだ家計簿データ
+    :type table: pa.Table
+    :param file_name: CSVファイル名（拡張子を.parquetに置き換えて保存する）
+    :type file_name: str
+    :param bucket_name: S3バケット名
+    :type bucket_name: str
+    :param s3_key: 保存先のキー（year=YYYY/month=M まで）
+    :type s3_key: str
+    :param filesystem: 書き込みに使うファイルシステム（Noneの場合はget_s3fsで取得する）
+    :type filesystem: pyarrow.fs.S3FileSystem | None
+    :return: 成功したかどうかと、保存先のパスあるいはエラーメッセージ
+    :rtype: tuple[bool, str]
+    """
+    try:
+        # S3のパス
+        parquet_name = file_name.rsplit('.', 1)[0] + ".parquet"
+        s3_path = f"{bucket_name}/{s3_key}/{parquet_name}"
+
+        # Snappy圧縮（デフォルト）で書き込む
+        pq.write_table(table, s3_path, filesystem=filesystem or get_s3fs())
+
+        return True, f"s3://{s3_path}"
+    except Exception as e:
+        return False, str(e)
+
+def convert_csvs_to_parquet(bucket_name: str, prefix: str, parquet_prefix: str) -> int:
+    """S3上の家計簿CSVを全てParquetに変換する
+
+    CSVと同じ year=YYYY/month=M のパーティション構成で parquet_prefix 配下に保存する。
+
+    :param bucket_name: S3バケット名
+    :type bucket_name: str
+    :param prefix: CSVファイルのプレフィックス
+    :type prefix: str
+    :param parquet_prefix: Parquetファイルの保存先プレフィックス
+    :type parquet_prefix: str
+    :return: 変換に成功したファイル数
+    :rtype: int
+    """
+
+    # ファイルシステムはループの外で1回だけ取得し、書き込みにも使い回す
+    s3 = get_s3fs()
+    csv_files = list_csv_files(bucket_name, prefix)
+    # プレフィックスの末尾のスラッシュの有無によらず、パーティション部分を取り出せるようにする
+    csv_root_length = len(f"{bucket_name}/{prefix.strip('/')}/")
+
+    converted_count = 0
+    for csv_file, _, _ in csv_files:
+        # バケット名・プレフィックスを除いたパーティション部分（year=YYYY/month=M）
+        partition, _, file_name = csv_file[csv_root_length:].rpartition('/')
+        if not partition:
+            print(f"Error converting {csv_file}: not under a year=YYYY/month=M partition")
+            continue
+
+        with s3.open_input_file(csv_file) as f:
+            file_content = f.read()
+
+        success, result = upload_parquet_to_s3(file_content, file_name, bucket_name, f"{parquet_prefix}/{partition}", filesystem=s3)
+        if success:
+            print(f"Converted: {csv_file} -> {result}")
+            converted_count += 1
+        else:
+            print(f"Error converting {csv_file}: {result}")
+
+    return converted_count
+
 def upload_to_s3(file_content, file_name, bucket_name: str, s3_key):
-    """S3にファイルをアップロード (s3fs使用)"""
+    """S3にファイルをアップロード"""
     try:
-        # s3fsの初期化
-        fs = s3fs.S3FileSystem(anon=False)
+        fs = get_s3fs()
 
         # S3のパス
         s3_path = f"{bucket_name}/{s3_key}/{file_name}"
 
         # ファイルをアップロード
-        with fs.open(s3_path, 'wb') as f:
+        with fs.open_output_stream(s3_path) as f:
             f.write(file_content)
 
         return True, f"s3://{s3_path}"
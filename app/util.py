@@ -1,5 +1,5 @@
 import os
-import toml
+import json
 from pathlib import Path
 
 print("util.pyが読み込まれました")
@@ -7,24 +7,36 @@ print("util.pyが読み込まれました")
 def create_secrets_toml():
     """環境変数からsecrets.tomlを生成"""
 
-    secrets_data = {
+    # テーブルごとの値（値がない項目は出力しない）
+    secrets_tables = {
         'auth': {
             'redirect_uri': os.getenv('REDIRECT_URI', 'http://localhost:8502/oauth2callback'),
             'cookie_secret': os.getenv('COOKIE_SECRET'),
-            'auth0': {
-                'client_id': os.getenv('CLIENT_ID'),
-                'client_secret': os.getenv('CLIENT_SECRET'),
-                'server_metadata_url': os.getenv('SERVER_METADATA_URL'),
-                'client_kwargs': {
-                    'prompt': os.getenv('CLIENT_KWARGS_PROMPT'),
-                }
-            }
+        },
+        'auth.auth0': {
+            'client_id': os.getenv('CLIENT_ID'),
+            'client_secret': os.getenv('CLIENT_SECRET'),
+            'server_metadata_url': os.getenv('SERVER_METADATA_URL'),
+        },
+        'auth.auth0.client_kwargs': {
+            'prompt': os.getenv('CLIENT_KWARGS_PROMPT'),
         }
     }
 
+    # 形の決まった小さなファイルなので、tomlライブラリを使わずに文字列として組み立てる
+    # TOMLの基本文字列のエスケープはJSONの文字列と互換のため、値はjson.dumpsで書き出す
+    secrets_toml = "\n".join(
+        f"[{table_name}]\n" + "".join(f"{key} = {json.dumps(value)}\n" for key, value in values.items() if value is not None)
+        for table_name, values in secrets_tables.items()
+    )
+
     # .streamlit/secrets.tomlを作成
     streamlit_dir = Path.home() / '.streamlit'
-    streamlit_dir.mkdir(exist_ok=True)
+    secrets_path = streamlit_dir / 'secrets.toml'
 
-    with open(streamlit_dir / 'secrets.toml', 'w') as f:
-        toml.dump(secrets_data, f)
+    # main.pyは再実行のたびに呼び出すため、内容が変わっていなければ書き込まない
+    if secrets_path.exists() and secrets_path.read_text() == secrets_toml:
+        return
+
+    streamlit_dir.mkdir(exist_ok=True)
+    secrets_path.write_text(secrets_toml)